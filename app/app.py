@@ -1,26 +1,33 @@
 import base64
+import hashlib
+import hmac
 import io
 import json
 import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 
 import awsgi
 import dotenv
+import numpy as np
+import orjson
+import pybase64
 import requests
 from flask import Flask, abort, request
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
 from linebot.models import (ButtonsTemplate, ImageMessage, ImageSendMessage,
                             MessageEvent, PostbackAction, PostbackEvent,
                             TemplateSendMessage, TextMessage, TextSendMessage)
 from PIL import Image
+from requests.adapters import HTTPAdapter
 
 IS_AWS_LAMBDA = 'AWS_LAMBDA_FUNCTION_NAME' in os.environ
 
 if IS_AWS_LAMBDA:
     # AWS Lambda環境(.envをterraformでENV_FILEにbase64エンコードして環境変数に設定済み)
-    env_file_content = base64.b64decode(os.environ['ENV_FILE'])
-    env_file_str = env_file_content.decode('utf-8')
+    env_file_str = pybase64.b64decode(os.environ['ENV_FILE'], validate=False).decode('utf-8')
     env_file = io.StringIO(env_file_str)
     dotenv.load_dotenv(stream=env_file)
 else:
@@ -29,63 +36,135 @@ else:
 
 
 app = Flask(__name__)
-app.logger.setLevel(logging.INFO)
+app.logger.setLevel(logging.WARNING if IS_AWS_LAMBDA else logging.INFO)
 
 CHANNEL_ACCESS_TOKEN = os.environ["CHANNEL_ACCESS_TOKEN"]
 CHANNEL_SECRET = os.environ["CHANNEL_SECRET"]
+CHANNEL_SECRET_BYTES = CHANNEL_SECRET.encode('utf-8')
 AUTH_USER_ID = os.environ["AUTH_USER_ID"]
 GYAZO_ACCESS_TOKEN = os.environ["GYAZO_ACCESS_TOKEN"]
 
 line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(CHANNEL_SECRET)
 
+ON_A_SIDE = 1080  # 結合後の画像の一辺
 
-def get_images_list() -> requests.Response:
-    url = f"https://api.gyazo.com/api/images?access_token={GYAZO_ACCESS_TOKEN}"
-    response = requests.request("GET", url)
-    app.logger.info(json.dumps(response.json(), indent=2))
+GYAZO_IMAGES_URL = "https://api.gyazo.com/api/images"
+GYAZO_UPLOAD_URL = "https://upload.gyazo.com/api/upload"
+GYAZO_PARAMS = {"access_token": GYAZO_ACCESS_TOKEN}
+GYAZO_PER_PAGE = 100  # 一覧APIの1ページあたりの最大件数(全削除時のみ使う)
+GYAZO_DELETE_LIST_PARAMS = {**GYAZO_PARAMS, "per_page": GYAZO_PER_PAGE}
+GYAZO_TIMEOUT = 10
+GYAZO_MAX_WORKERS = 8
+
+# Gyazoへの接続を使い回す(リクエストごとのTCP/TLSハンドシェイクを避ける)
+gyazo_session = requests.Session()
+gyazo_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+# upload_imageのエンコード先バッファ(warmなコンテナでは呼び出しごとに確保し直さない)
+upload_buffer = threading.local()
+
+
+def log_response(response: requests.Response) -> None:
+    # INFOが無効な場合はレスポンスのデコードや整形をしない
+    if app.logger.isEnabledFor(logging.INFO):
+        app.logger.info("gyazo %s %s: %s", response.request.method, response.status_code, response.text)
+
+
+def verify_signature(body: bytes, signature: str) -> bool:  # X-Line-Signatureの検証
+    mac = hmac.new(CHANNEL_SECRET_BYTES, body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(mac), signature.encode('utf-8'))
+
+
+def get_images_list(params: dict = GYAZO_PARAMS) -> requests.Response:
+    response = gyazo_session.get(GYAZO_IMAGES_URL, params=params, timeout=GYAZO_TIMEOUT)
+    log_response(response)
     return response
 
 
 def get_image(image_url: str) -> Image:
-    response = requests.request("GET", image_url)
-    image = Image.open(io.BytesIO(response.content))
+    # response.rawはseekできないため、Image.open内部でBytesIO(fp.read())に一度全体を読み込む
+    # (メモリ使用量はresponse.contentを使う場合と同じ。stream=Trueはload後にcloseして接続を返すため)
+    with gyazo_session.get(image_url, stream=True, timeout=GYAZO_TIMEOUT) as response:
+        response.raw.decode_content = True
+        image = Image.open(response.raw)
+        # JPEGは幅がON_A_SIDEを下回らない範囲で縮小しながらデコードする(DCTスケーリング)
+        image.draft('RGB', (ON_A_SIDE, 1))
+        image.load()
     return image
 
 
 def delete_image(image_id: str) -> requests.Response:
-    url = f"https://api.gyazo.com/api/images/{image_id}?access_token={GYAZO_ACCESS_TOKEN}"
-    response = requests.request("DELETE", url)
-    app.logger.info(json.dumps(response.json(), indent=2))
+    response = gyazo_session.delete(GYAZO_IMAGES_URL + "/" + image_id, params=GYAZO_PARAMS, timeout=GYAZO_TIMEOUT)
+    log_response(response)
     return response
 
 
 def upload_image(image: Image) -> requests.Response:
-    url = f"https://upload.gyazo.com/api/upload?access_token={GYAZO_ACCESS_TOKEN}"
-    image_byte_array = io.BytesIO()
-    image.save(image_byte_array, format="PNG")
+    if image.mode != 'RGB':  # JPEGはアルファチャンネルを持てない
+        image = image.convert('RGB')
+    image_byte_array = getattr(upload_buffer, 'buffer', None)
+    if image_byte_array is None:
+        image_byte_array = upload_buffer.buffer = io.BytesIO()
+    # truncate(0)は確保済みの領域を解放してしまうため、書き込み後に末尾だけ切り詰める
     image_byte_array.seek(0)
+    image.save(image_byte_array, format="JPEG", quality=85, optimize=False, progressive=False)
+    image_byte_array.truncate()
+    image_byte_array.seek(0)
+    return upload_image_data(image_byte_array, 'upload.jpg', 'image/jpeg')
+
+
+def upload_image_data(data, filename: str, content_type: str) -> requests.Response:  # エンコード済みの画像をそのままアップロード
     files = {
-        'imagedata': image_byte_array
+        'imagedata': (filename, data, content_type)
     }
-    response = requests.request("POST", url, files=files)
-    app.logger.info(json.dumps(response.json(), indent=2))
+    response = gyazo_session.post(GYAZO_UPLOAD_URL, params=GYAZO_PARAMS, files=files, timeout=GYAZO_TIMEOUT)
+    log_response(response)
     return response
 
 
-def delete_all_images():
-    response = get_images_list()
-    images = response.json()
-    for image in images:
-        delete_image(image["image_id"])
-    return
+def get_message_content(message_id: str) -> bytearray:
+    # Content-Lengthぶんのbufferを先に確保して読み込む(bytesの連結による再確保を避ける)
+    message_content = line_bot_api.get_message_content(message_id)
+    content_length = message_content.response.headers.get('Content-Length')
+    if content_length is None:
+        return bytearray(message_content.content)
+    buffer = bytearray(int(content_length))
+    offset = 0
+    for chunk in message_content.iter_content(65536):
+        buffer[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    del buffer[offset:]
+    return buffer
+
+
+def delete_all_images() -> list:  # 全ページの画像を削除し、残っている画像の一覧を返す
+    images = get_images_list(GYAZO_DELETE_LIST_PARAMS).json()
+    while len(images) > 0:
+        # 削除も互いに独立したネットワーク待ちなのでスレッドで並列化する
+        with ThreadPoolExecutor(max_workers=min(GYAZO_MAX_WORKERS, len(images))) as executor:
+            responses = list(executor.map(lambda image: delete_image(image["image_id"]), images))
+        if not all(response.ok for response in responses):
+            return get_images_list(GYAZO_DELETE_LIST_PARAMS).json()
+        if len(images) < GYAZO_PER_PAGE:  # 1ページに収まっていれば再取得は不要
+            return []
+        # 1ページに収まらなかった分を取得し直す(削除したはずの画像が残っていれば失敗として返す)
+        deleted_ids = {image["image_id"] for image in images}
+        images = get_images_list(GYAZO_DELETE_LIST_PARAMS).json()
+        if any(image["image_id"] in deleted_ids for image in images):
+            return images
+    return []
 
 
 def get_all_images() -> list[Image]:  # type: ignore
     response = get_images_list()
     images = response.json()
-    images.sort(key=lambda x: x["created_at"])
-    image_list = [get_image(image["url"]) for image in images]
+    images.sort(key=itemgetter("created_at"))
+    if len(images) == 0:
+        return []
+    # ダウンロードはネットワーク待ちなのでスレッドで並列化する
+    with ThreadPoolExecutor(max_workers=min(GYAZO_MAX_WORKERS, len(images))) as executor:
+        image_list = list(executor.map(lambda image: get_image(image["url"]), images))
     return image_list
 
 
@@ -97,40 +176,70 @@ def hello_world():
 @app.route("/callback", methods=['POST'])   # LINEからのリクエストを受け取るエンドポイント
 def callback():
     signature = request.headers['X-Line-Signature']
-    body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
+    # bodyはbytesのまま読んで署名検証とuser_id等の取得に使う
+    # (handler.handle()はSDK側でも署名を検証・パースするため、str(text)で渡す)
+    body = request.get_data()
+    # JSONのパースやログ出力より先に署名を検証する
+    if not verify_signature(body, signature):
+        abort(400)
+    if app.logger.isEnabledFor(logging.INFO):
+        app.logger.info("Request body: %s", body.decode('utf-8', 'replace'))
+    body_json = orjson.loads(body)
 
     try:
-        user_id = request.json['events'][0]['source']['userId']
+        event = body_json['events'][0]
+        user_id = event['source']['userId']
     except (KeyError, IndexError):  # developer consoleからのテスト用
         return 'OK'
 
     if user_id != AUTH_USER_ID:  # 認証ユーザー以外は返信しない
         line_bot_api.reply_message(
-            request.json['events'][0]['replyToken'],
+            event['replyToken'],
             TextSendMessage(text="This line bot is only for specific user, sorry. Please ask admin.")
         )
         return 'OK'
 
     try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
-        abort(400)
+        handler.handle(body.decode('utf-8'), signature)
     except Exception as e:
-        app.logger.info(e)
+        app.logger.exception(e)
         line_bot_api.reply_message(
-            request.json['events'][0]['replyToken'],
+            event['replyToken'],
             TextSendMessage(text="Error occurred. Please ask admin.")
         )
         abort(500)
     return 'OK'
 
 
+# 内容が固定の返信メッセージは一度だけ組み立てて使い回す
+MERGE_CONFIRM_MESSAGE = TemplateSendMessage(
+    alt_text='Buttons template',
+    template=ButtonsTemplate(
+        text='結合しますか？',
+        actions=[
+            PostbackAction(
+                label='merge',
+                display_text='merge',
+                data='merge'
+            )
+        ]))
+DELETE_ALL_CONFIRM_MESSAGE = TemplateSendMessage(
+    alt_text='Buttons template',
+    template=ButtonsTemplate(
+        text='全ての画像を削除しますか？',
+        actions=[
+            PostbackAction(
+                label='delete',
+                display_text='delete',
+                data='delete'
+            )
+        ]))
+
+
 @handler.add(MessageEvent, message=TextMessage)  # テキストメッセージ時、画像一覧を返信して削除するか確認
 def handle_message(event):
     response = get_images_list()
     images = response.json()
-    app.logger.info(json.dumps(images, indent=2))
     if len(images) == 0:
         line_bot_api.reply_message(
             event.reply_token,
@@ -169,28 +278,18 @@ def handle_message(event):
 
 @ handler.add(MessageEvent, message=ImageMessage)   # 画像メッセージ時、uploadして結合するか確認
 def handle_image(event):
-    # get image
-    message_content = line_bot_api.get_message_content(event.message.id)
-    image = Image.open(io.BytesIO(message_content.content))
+    # get image (デコード・再エンコードはせず、受け取ったデータをそのままアップロードする)
+    data = get_message_content(event.message.id)
+    image = Image.open(io.BytesIO(data))  # sizeを得るためにヘッダーだけ読む
     image_size = image.size
-    upload_image(image)
+    upload_image_data(data, f"upload.{image.format.lower()}", Image.MIME.get(image.format, 'application/octet-stream'))
 
     # 返信
     line_bot_api.reply_message(
         event.reply_token,
         [
             TextSendMessage(text=f"画像を受け取りました。{image_size=}, "),
-            TemplateSendMessage(
-                alt_text='Buttons template',
-                template=ButtonsTemplate(
-                    text='結合しますか？',
-                    actions=[
-                        PostbackAction(
-                            label='merge',
-                            display_text='merge',
-                            data='merge'
-                        )
-                    ])),
+            MERGE_CONFIRM_MESSAGE,
         ]
     )
 
@@ -198,8 +297,7 @@ def handle_image(event):
 @ handler.add(PostbackEvent)    # ポストバック処理（delete, merge）
 def handle_postback(event):
     if event.postback.data == 'delete':
-        delete_all_images()
-        images = get_images_list().json()
+        images = delete_all_images()
         if len(images) == 0:
             line_bot_api.reply_message(
                 event.reply_token,
@@ -225,43 +323,52 @@ def handle_postback(event):
                     original_content_url=main_URL,
                     preview_image_url=thumb_URL
                 ),
-            ] + [
-                TemplateSendMessage(
-                    alt_text='Buttons template',
-                    template=ButtonsTemplate(
-                        text=f'全ての画像を削除しますか？',
-                        actions=[
-                            PostbackAction(
-                                label='delete',
-                                display_text='delete',
-                                data='delete'
-                            )
-                        ]))
+                DELETE_ALL_CONFIRM_MESSAGE,
             ]
         )
 
 
+def image_to_array(image: Image) -> np.ndarray:
+    # tobytes()は64KBずつエンコードして連結するため、rawエンコーダーで一度にエンコードする
+    bands = len(image.getbands())
+    encoder = Image._getencoder(image.mode, 'raw', image.mode)
+    encoder.setimage(image.im, (0, 0) + image.size)
+    _, errcode, data = encoder.encode(image.width * image.height * bands)
+    if errcode <= 0:
+        raise RuntimeError(f"encoder error {errcode} in image_to_array")
+    return np.frombuffer(data, dtype=np.uint8).reshape(image.height, image.width, bands)
+
+
 def edit_image() -> requests.Response:  # 画像を結合してアップロード
     images = get_all_images()
 
     # 1枚の1080x1080にまとめる
-    ON_A_SIDE = 1080
     SECTION_HEIGHT = ON_A_SIDE//len(images)
-    new_image = Image.new('RGB', (ON_A_SIDE, ON_A_SIDE))
+    # 各セクションは確保済みの配列に直接書き込み、最後に一度だけImageに変換する
+    canvas = np.zeros((ON_A_SIDE, ON_A_SIDE, 3), dtype=np.uint8)
     cur_height = 0
 
     for i, image in enumerate(images):
         aim_height = SECTION_HEIGHT if i != len(images) - 1 else 1080 - cur_height
 
-        image = image.resize((ON_A_SIDE, int(image.height * (ON_A_SIDE / image.width))))
-        image = image.crop((0, (image.height - aim_height) // 2, ON_A_SIDE, (image.height + aim_height) // 2))
-
-        new_image.paste(image, (0, cur_height))
-        cur_height += image.height
-
+        # 切り抜く範囲を元画像の座標で求め、resize(box=...)で縮小と切り抜きを一度に行う
+        # (高さが足りない画像は上下を黒で余白にする)
+        resized_height = int(image.height * (ON_A_SIDE / image.width))
+        section_height = min(aim_height, resized_height)
+        box_height = image.height * section_height / resized_height
+        box_top = (image.height - box_height) / 2
+        section = image.resize((ON_A_SIDE, section_height), Image.LANCZOS,
+                               box=(0, box_top, image.width, box_top + box_height))
+        if section.mode != 'RGB':
+            section = section.convert('RGB')
+
+        section_top = cur_height + (aim_height - section_height) // 2
+        canvas[section_top:section_top + section_height] = image_to_array(section)
+        cur_height += aim_height
+
+    new_image = Image.fromarray(canvas, 'RGB')
     assert new_image.size == (ON_A_SIDE, ON_A_SIDE)
     res = upload_image(new_image)
-    app.logger.info(json.dumps(res.json(), indent=2))
     return res
 
 
@@ -274,5 +381,5 @@ def lambda_handler(event, context):
     return awsgi.response(app, event, context)
 
 
-if not IS_AWS_LAMBDA:
-    app.run(host='0.0.0.0', port=5000, debug=True)
+if __name__ == "__main__":  # python app.pyで直接起動した場合のみ開発サーバーを立ち上げる
+    app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
@@ -0,0 +1,10 @@
+import os
+import sys
+from pathlib import Path
+
+# app.pyはimport時に環境変数を読むため、テスト用の値を先に設定する
+os.environ.setdefault("CHANNEL_ACCESS_TOKEN", "test-access-token")
+os.environ.setdefault("CHANNEL_SECRET", "test-channel-secret")
+os.environ.setdefault("AUTH_USER_ID", "U0123456789abcdef0123456789abcdef")
+os.environ.setdefault("GYAZO_ACCESS_TOKEN", "test-gyazo-token")
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app"))
@@ -0,0 +1,83 @@
+import json
+
+import pytest
+import requests
+
+import app
+
+GYAZO_DEFAULT_PER_PAGE = 20
+
+
+class FakeGyazo:
+    # gyazo_sessionの代わりに、ページングされる画像一覧と削除APIを再現する
+    def __init__(self, count, failing_ids=(), undeletable_ids=()):
+        self.images = [{"image_id": str(i)} for i in range(count)]
+        self.failing_ids = set(failing_ids)
+        self.undeletable_ids = set(undeletable_ids)
+        self.list_params = []
+
+    def get(self, url, params=None, timeout=None):
+        self.list_params.append(dict(params))
+        per_page = params.get("per_page", GYAZO_DEFAULT_PER_PAGE)
+        return make_response("GET", url, 200, self.images[:per_page])
+
+    def delete(self, url, params=None, timeout=None):
+        image_id = url.rsplit("/", 1)[-1]
+        if image_id in self.failing_ids:
+            return make_response("DELETE", url, 500, {"message": "error"})
+        if image_id not in self.undeletable_ids:
+            self.images = [image for image in self.images if image["image_id"] != image_id]
+        return make_response("DELETE", url, 200, {"image_id": image_id})
+
+
+def make_response(method, url, status_code, data):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(data).encode("utf-8")
+    response.request = requests.Request(method, url).prepare()
+    return response
+
+
+@pytest.fixture
+def fake_gyazo(monkeypatch):
+    def install(*args, **kwargs):
+        gyazo = FakeGyazo(*args, **kwargs)
+        monkeypatch.setattr(app, "gyazo_session", gyazo)
+        return gyazo
+    return install
+
+
+@pytest.mark.parametrize("count", [0, 1, 99, 100, 101, 250])
+def test_delete_all_images_deletes_every_page(fake_gyazo, count):
+    gyazo = fake_gyazo(count)
+
+    assert app.delete_all_images() == []
+    assert gyazo.images == []
+    assert all(params["per_page"] == app.GYAZO_PER_PAGE for params in gyazo.list_params)
+
+
+def test_delete_all_images_returns_remaining_on_failure(fake_gyazo):
+    gyazo = fake_gyazo(250, failing_ids={"150"})
+
+    remaining = app.delete_all_images()
+
+    # 失敗したバッチで打ち切るため、未処理の後続ページも残りとして返る
+    assert "150" in [image["image_id"] for image in remaining]
+    assert remaining == gyazo.images
+
+
+def test_delete_all_images_stops_when_deleted_image_is_still_listed(fake_gyazo):
+    gyazo = fake_gyazo(150, undeletable_ids={"0"})
+
+    remaining = app.delete_all_images()
+
+    assert "0" in [image["image_id"] for image in remaining]
+    assert remaining == gyazo.images
+    assert len(gyazo.list_params) == 2
+
+
+def test_get_images_list_uses_default_page_size(fake_gyazo):
+    gyazo = fake_gyazo(50)
+
+    assert len(app.get_images_list().json()) == GYAZO_DEFAULT_PER_PAGE
+    assert "per_page" not in gyazo.list_params[0]
@@ -0,0 +1,48 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+from pathlib import Path
+
+import app
+
+EVENTS_DIR = Path(__file__).resolve().parent / "events"
+
+
+def load_callback_event(is_base64_encoded: bool = False) -> dict:
+    # Lambda関数URLからのPOST /callback(content-lengthヘッダーなし)
+    event = json.loads((EVENTS_DIR / "function_url_callback.json").read_text())
+    body = event["body"].encode("utf-8")
+    mac = hmac.new(os.environ["CHANNEL_SECRET"].encode("utf-8"), body, hashlib.sha256).digest()
+    event["headers"]["x-line-signature"] = base64.b64encode(mac).decode("utf-8")
+    if is_base64_encoded:
+        event["body"] = base64.b64encode(body).decode("utf-8")
+        event["isBase64Encoded"] = True
+    return event
+
+
+def test_callback_without_content_length_header():
+    event = load_callback_event()
+    assert "content-length" not in event["headers"]
+
+    response = app.lambda_handler(event, None)
+
+    assert int(response["statusCode"]) == 200
+    assert response["body"] == "OK"
+
+
+def test_callback_with_base64_encoded_body():
+    response = app.lambda_handler(load_callback_event(is_base64_encoded=True), None)
+
+    assert int(response["statusCode"]) == 200
+    assert response["body"] == "OK"
+
+
+def test_callback_with_invalid_signature():
+    event = load_callback_event()
+    event["headers"]["x-line-signature"] = "invalid"
+
+    response = app.lambda_handler(event, None)
+
+    assert int(response["statusCode"]) == 400